@@ -0,0 +1,114 @@
+# fake_telegram.py — local stand-in for the Bot API used by the benchmarks
+import asyncio
+import random
+import time
+import zlib
+from collections import Counter
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "GemAd", "username": "gemad_bench_bot"}
+
+def channel_chat_id(username: str) -> int:
+    return -1000000000000 - zlib.crc32(username.lower().encode()) % 10**9
+
+class FakeTelegram:
+    """aiohttp app answering the Bot API methods the bot uses.
+
+    latency/jitter are in seconds. retry_ratio is the share of requests answered
+    with 429 and `retry_after`; member_ratio is the share of (channel, user)
+    pairs that getChatMember reports as members (stable per pair). Channels whose
+    username starts with "missing" are answered with "chat not found".
+    """
+
+    def __init__(self, latency=0.05, jitter=0.0, retry_ratio=0.0, retry_after=1, member_ratio=1.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.retry_ratio = retry_ratio
+        self.retry_after = retry_after
+        self.member_ratio = member_ratio
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.retries = Counter()
+        self.message_id = 0
+        self.runner = None
+
+    async def start(self, host="127.0.0.1", port=0) -> str:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    def reset(self):
+        self.calls.clear()
+        self.retries.clear()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await request.post()
+        self.calls[method] += 1
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if self.retry_ratio and self.random.random() < self.retry_ratio:
+            self.retries[method] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+
+        handler = getattr(self, f"api_{method}", None)
+        if handler is None:
+            return web.json_response({"ok": True, "result": True})
+        return handler(params)
+
+    @staticmethod
+    def ok(result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    @staticmethod
+    def error(code: int, description: str) -> web.Response:
+        return web.json_response({"ok": False, "error_code": code, "description": description}, status=code)
+
+    def api_getMe(self, params):
+        return self.ok(BOT_USER)
+
+    def api_getChat(self, params):
+        chat = str(params.get("chat_id", ""))
+        if chat.lstrip("-").isdigit():
+            return self.ok({"id": int(chat), "type": "channel", "title": f"Channel {chat}"})
+        username = chat.lstrip("@")
+        if not chat.startswith("@") or username.lower().startswith("missing"):
+            return self.error(400, "Bad Request: chat not found")
+        return self.ok({"id": channel_chat_id(username), "type": "channel", "title": username, "username": username})
+
+    def api_getChatMember(self, params):
+        chat_id, user_id = str(params.get("chat_id")), int(params.get("user_id"))
+        bucket = zlib.crc32(f"{chat_id}:{user_id}".encode()) % 10000
+        status = "member" if bucket < self.member_ratio * 10000 else "left"
+        return self.ok({"status": status, "user": {"id": user_id, "is_bot": False, "first_name": "User"}})
+
+    def _message(self, params, **extra):
+        self.message_id += 1
+        chat_id = int(params.get("chat_id"))
+        return self.ok({
+            "message_id": self.message_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER, **extra,
+        })
+
+    def api_sendMessage(self, params):
+        return self._message(params, text=str(params.get("text", "")))
+
+    def api_sendPhoto(self, params):
+        photo = [{"file_id": "bench-photo", "file_unique_id": "bench-photo", "width": 1, "height": 1}]
+        return self._message(params, photo=photo, caption=str(params.get("caption", "")))
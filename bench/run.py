@@ -0,0 +1,323 @@
+# run.py — offline throughput benchmarks for the checker and the webhook
+#
+#   pip install -r bench/requirements.txt
+#   python bench/run.py --latency 0.05 checker --tasks 5000 --channels 20
+#   python bench/run.py --latency 0.2 webhook --updates 2000 --mode queue
+#
+# Telegram is replaced by a local fake Bot API server (bench/fake_telegram.py)
+# and Mongo by mongomock-motor, unless --mongo-uri points at a local mongod
+# (a throwaway `gemad_bench` database is used and dropped afterwards).
+# mongomock scans collections linearly, so at large --tasks its own CPU time
+# dominates; API/DB call counts are exact either way, but take absolute
+# throughput numbers against --mongo-uri.
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_telegram import FakeTelegram  # noqa: E402
+
+COLLECTIONS = ("pending", "users", "channels", "rewards", "memberships", "outbox")
+COUNTED_METHODS = {
+    "find", "find_one", "find_one_and_update", "insert_one", "insert_many", "update_one", "update_many",
+    "delete_one", "delete_many", "bulk_write", "count_documents", "create_index", "watch",
+}
+
+class CountingCollection:
+    """Wraps a Motor collection and counts calls that reach the database."""
+
+    def __init__(self, inner, calls: Counter):
+        self._inner = inner
+        self._calls = calls
+
+    def __getattr__(self, name):
+        attr = getattr(self._inner, name)
+        if name not in COUNTED_METHODS:
+            return attr
+
+        def counted(*args, **kwargs):
+            self._calls[f"{self._inner.name}.{name}"] += 1
+            return attr(*args, **kwargs)
+        return counted
+
+def percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def configure_env(args, api_url: str):
+    os.environ.update({
+        "BOT_TOKEN": "123456:bench-token",
+        "MONGO_URI": args.mongo_uri or "mongodb://127.0.0.1:27017",
+        "TELEGRAM_API_URL": api_url,
+        "WEBHOOK_URL": "",
+        "RUN_CHECKER": "0",
+        "LOG_LEVEL": args.log_level,
+        "API_GLOBAL_RATE": str(args.api_rate),
+        "API_PER_CHAT_RATE": str(args.api_per_chat_rate),
+    })
+    if args.concurrency:
+        os.environ["CHECK_CONCURRENCY"] = str(args.concurrency)
+    if args.batch_size:
+        os.environ["CHECK_BATCH_SIZE"] = str(args.batch_size)
+    if getattr(args, "mode", None):
+        os.environ["WEBHOOK_MODE"] = args.mode
+    if getattr(args, "workers", None):
+        os.environ["WEBHOOK_WORKERS"] = str(args.workers)
+    if getattr(args, "queue_size", None):
+        os.environ["WEBHOOK_QUEUE_SIZE"] = str(args.queue_size)
+
+def record_decisions(bot_module) -> dict:
+    """Stamps the time CheckBatch.grant() is called for each task id."""
+    decided = {}
+    grant = bot_module.CheckBatch.grant
+
+    def timed_grant(self, task, *args, **kwargs):
+        decided[str(task["_id"])] = datetime.utcnow()
+        return grant(self, task, *args, **kwargs)
+    bot_module.CheckBatch.grant = timed_grant
+    return decided
+
+def attach_database(bot_module, args, db_calls: Counter):
+    if args.mongo_uri:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        client = AsyncIOMotorClient(args.mongo_uri)
+    else:
+        from mongomock_motor import AsyncMongoMockClient
+        client = AsyncMongoMockClient()
+    database = client["gemad_bench"]
+    names = {"pending": "pendings"}
+    for attr in COLLECTIONS:
+        setattr(bot_module, attr, CountingCollection(database[names.get(attr, attr)], db_calls))
+    return client, database
+
+async def cleanup(bot_module, client, database, args):
+    if args.mongo_uri:
+        await client.drop_database(database.name)
+    await bot_module.bot.session.close()
+
+def report(title: str, results: dict, as_json: bool):
+    if as_json:
+        print(json.dumps({"benchmark": title, **results}, default=str))
+        return
+    print(f"== {title}")
+    for key, value in results.items():
+        if isinstance(value, float):
+            value = f"{value:.4f}"
+        print(f"  {key:<28} {value}")
+
+# -----------------------
+# Checker benchmark
+# -----------------------
+async def bench_checker(args):
+    fake = FakeTelegram(args.latency, args.jitter, args.retry_ratio, args.retry_after, args.member_ratio, args.seed)
+    configure_env(args, await fake.start())
+    import bot as bot_module
+
+    db_calls = Counter()
+    client, database = attach_database(bot_module, args, db_calls)
+    decided_at = record_decisions(bot_module)
+    try:
+        await bot_module.ensure_indexes()
+        due = datetime.utcnow()
+        await bot_module.pending.insert_many([
+            {"telegramId": str(100000 + i), "channel": f"@bench_channel_{i % args.channels}",
+             "reward": 15, "status": "waiting", "checkAfter": due}
+            for i in range(args.tasks)
+        ])
+        fake.reset()
+        db_calls.clear()
+
+        start = datetime.utcnow()
+        started = time.perf_counter()
+        processed = 0
+        while True:
+            done = await bot_module.process_queue_iteration()
+            if not done:
+                break
+            processed += done
+        elapsed = time.perf_counter() - started
+        checker_api = sum(fake.calls.values())
+        checker_db = sum(db_calls.values())
+
+        outbox_started = time.perf_counter()
+        sent = 0
+        if args.drain_outbox:
+            while True:
+                done = await bot_module.notifier.send_round()
+                if not done:
+                    break
+                sent += done
+        outbox_elapsed = time.perf_counter() - outbox_started
+
+        # Decisions are timed per task by record_decisions; grantedAt is
+        # stamped once per flush when the balance write goes out.
+        granted = await bot_module.rewards.find({}, {"grantedAt": 1}).to_list(length=None)
+        decided = [(decided_at[doc["_id"]] - start).total_seconds() for doc in granted if doc["_id"] in decided_at]
+        written = [(doc["grantedAt"] - start).total_seconds() for doc in granted]
+        rewarded = max(len(granted), 1)
+        report("checker", {
+            "tasks": processed,
+            "rewarded": len(granted),
+            "seconds": elapsed,
+            "tasks_per_second": processed / elapsed if elapsed else 0.0,
+            "decision_latency_p50_s": percentile(decided, 50),
+            "decision_latency_p99_s": percentile(decided, 99),
+            "reward_latency_p50_s": percentile(written, 50),
+            "reward_latency_p99_s": percentile(written, 99),
+            "api_calls_per_reward": checker_api / rewarded,
+            "db_calls_per_reward": checker_db / rewarded,
+            "api_calls": dict(fake.calls),
+            "api_retry_after_injected": dict(fake.retries),
+            "db_calls": dict(db_calls),
+            "notifications_sent": sent,
+            "notifications_per_second": sent / outbox_elapsed if sent and outbox_elapsed else 0.0,
+        }, args.json)
+    finally:
+        await cleanup(bot_module, client, database, args)
+        await fake.stop()
+
+# -----------------------
+# Webhook benchmark
+# -----------------------
+async def post_asgi(app, body: bytes) -> int:
+    """POST `body` to `/` of an ASGI app in-process and return the status code."""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "/", "raw_path": b"/", "query_string": b"", "root_path": "",
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        "client": ("127.0.0.1", 50000), "server": ("127.0.0.1", 80),
+    }
+    finished = asyncio.Event()
+    status = 0
+    body_sent = False
+
+    async def receive():
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body" and not message.get("more_body"):
+            finished.set()
+
+    await app(scope, receive, send)
+    return status
+
+def make_update(update_id: int, chat_member: bool) -> bytes:
+    user = {"id": 200000 + update_id, "is_bot": False, "first_name": "Bench"}
+    now = int(time.time())
+    if chat_member:
+        chat = {"id": -1001000000001, "type": "channel", "title": "Bench", "username": "bench_channel_0"}
+        update = {"update_id": update_id, "chat_member": {
+            "chat": chat, "from": user, "date": now,
+            "old_chat_member": {"status": "left", "user": user},
+            "new_chat_member": {"status": "member", "user": user},
+        }}
+    else:
+        update = {"update_id": update_id, "message": {
+            "message_id": update_id, "date": now, "chat": {"id": user["id"], "type": "private"}, "from": user,
+            "text": "/start", "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        }}
+    return json.dumps(update).encode()
+
+async def bench_webhook(args):
+    fake = FakeTelegram(args.latency, args.jitter, args.retry_ratio, args.retry_after, args.member_ratio, args.seed)
+    configure_env(args, await fake.start())
+    os.chdir(ROOT)  # start_handler opens images/gemad.jpg relative to the repo
+    import bot as bot_module
+
+    db_calls = Counter()
+    client, database = attach_database(bot_module, args, db_calls)
+    try:
+        await bot_module.on_startup()
+        bodies = [make_update(i, (i % 100) < args.chat_member_share * 100) for i in range(1, args.updates + 1)]
+        if args.duplicates:
+            bodies += bodies[:int(len(bodies) * args.duplicates)]
+        fake.reset()
+
+        latencies, statuses = [], Counter()
+        pending_bodies = iter(bodies)
+
+        async def sender():
+            for body in pending_bodies:
+                t0 = time.perf_counter()
+                statuses[await post_asgi(bot_module.app, body)] += 1
+                latencies.append(time.perf_counter() - t0)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(sender() for _ in range(args.connections)))
+        acked = time.perf_counter() - started
+        await bot_module.update_queue.join()
+        handled = time.perf_counter() - started
+
+        report("webhook", {
+            "requests": len(bodies),
+            "mode": bot_module.WEBHOOK_MODE,
+            "ack_seconds": acked,
+            "acks_per_second": len(bodies) / acked if acked else 0.0,
+            "handled_seconds": handled,
+            "updates_per_second": args.updates / handled if handled else 0.0,
+            "webhook_latency_p50_s": percentile(latencies, 50),
+            "webhook_latency_p99_s": percentile(latencies, 99),
+            "statuses": dict(statuses),
+            "api_calls_per_update": sum(fake.calls.values()) / max(args.updates, 1),
+            "db_calls_per_update": sum(db_calls.values()) / max(args.updates, 1),
+            "api_calls": dict(fake.calls),
+            "db_calls": dict(db_calls),
+        }, args.json)
+    finally:
+        await bot_module.on_shutdown()
+        await cleanup(bot_module, client, database, args)
+        await fake.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline throughput benchmarks for the checker and the webhook.")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake Bot API latency, seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="uniform +/- jitter on latency, seconds")
+    parser.add_argument("--retry-ratio", type=float, default=0.0, help="share of API requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after sent with injected 429s")
+    parser.add_argument("--member-ratio", type=float, default=1.0, help="share of users reported as channel members")
+    parser.add_argument("--api-rate", type=float, default=10000, help="API_GLOBAL_RATE for the run (default: effectively unlimited)")
+    parser.add_argument("--api-per-chat-rate", type=float, default=10000, help="API_PER_CHAT_RATE for the run")
+    parser.add_argument("--concurrency", type=int, help="CHECK_CONCURRENCY for the run")
+    parser.add_argument("--batch-size", type=int, help="CHECK_BATCH_SIZE for the run")
+    parser.add_argument("--mongo-uri", help="use a local mongod instead of the in-memory stand-in")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print one JSON line instead of a table")
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    checker = sub.add_parser("checker", help="pending tasks/s cleared by process_queue_iteration")
+    checker.add_argument("--tasks", type=int, default=2000)
+    checker.add_argument("--channels", type=int, default=10)
+    checker.add_argument("--drain-outbox", action="store_true", help="also time delivering the reward notifications")
+
+    webhook = sub.add_parser("webhook", help="updates/s absorbed by telegram_webhook")
+    webhook.add_argument("--updates", type=int, default=2000)
+    webhook.add_argument("--connections", type=int, default=40, help="concurrent webhook requests (Telegram max_connections)")
+    webhook.add_argument("--mode", choices=("queue", "sync"), help="WEBHOOK_MODE for the run")
+    webhook.add_argument("--workers", type=int, help="WEBHOOK_WORKERS for the run")
+    webhook.add_argument("--queue-size", type=int, help="WEBHOOK_QUEUE_SIZE for the run")
+    webhook.add_argument("--chat-member-share", type=float, default=0.0, help="share of chat_member updates instead of /start")
+    webhook.add_argument("--duplicates", type=float, default=0.0, help="share of updates redelivered a second time")
+
+    args = parser.parse_args()
+    asyncio.run(bench_checker(args) if args.benchmark == "checker" else bench_webhook(args))
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,35 @@
 # bot.py — stable version with detailed logging and proper channel -> chat_id resolution
 import os
+import sys
+import copy
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+import threading
+import heapq
+import uuid
+import socket
 import asyncio
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, FSInputFile, WebAppInfo
 from aiogram.enums import ChatMemberStatus
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import DeleteOne, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, OperationFailure
 from fastapi import FastAPI, Request
 from fastapi.responses import PlainTextResponse
+from pydantic import ValidationError
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -16,45 +37,348 @@ load_dotenv()
 TOKEN = os.getenv("BOT_TOKEN")
 MONGO_URI = os.getenv("MONGO_URI")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
-CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", 10))  # seconds
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").strip()  # alternative Bot API server, e.g. a local one
+CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", 10))  # seconds, longest poll when change streams are unavailable
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", 1))  # seconds, shortest poll
+SCHEDULER_PRELOAD = int(os.getenv("SCHEDULER_PRELOAD", 1000))  # upcoming checkAfter times kept in memory
+SCHEDULER_RESYNC = int(os.getenv("SCHEDULER_RESYNC", 60))  # seconds between full reloads while watching
+CHECK_CONCURRENCY = max(1, int(os.getenv("CHECK_CONCURRENCY", 16)))  # tasks processed in parallel
+CHECK_BATCH_SIZE = max(1, int(os.getenv("CHECK_BATCH_SIZE", 500)))  # tasks claimed per Mongo read
+CHECK_FLUSH_SIZE = max(1, int(os.getenv("CHECK_FLUSH_SIZE", 50)))  # grants that trigger an early bulk_write
+CHECK_FLUSH_INTERVAL = float(os.getenv("CHECK_FLUSH_INTERVAL", 0.5))  # seconds between bulk_writes while a chunk runs
+MEMBERSHIP_TTL = int(os.getenv("MEMBERSHIP_TTL", 300))  # seconds a polled/unconfirmed membership stays trusted
+MEMBERSHIP_PUSH_TTL = int(os.getenv("MEMBERSHIP_PUSH_TTL", 86400))  # seconds a pushed membership stays trusted
+LEASE_SECONDS = int(os.getenv("LEASE_SECONDS", 60))  # how long a claimed task stays owned without renewal
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 100))  # notifications claimed per send round
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 2))  # seconds between outbox polls when idle
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 8))  # delivery attempts before giving up
+OUTBOX_BACKOFF_MAX = int(os.getenv("OUTBOX_BACKOFF_MAX", 600))  # seconds, cap for retry backoff
+OUTBOX_RATE_SHARE = min(1.0, max(0.05, float(os.getenv("OUTBOX_RATE_SHARE", 0.5))))  # share of API_GLOBAL_RATE notifications may use
+RUN_CHECKER = os.getenv("RUN_CHECKER", "1").strip().lower() not in ("0", "false", "no")  # start checker in the web process
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "queue").strip().lower()  # "queue" acks at once, "sync" waits for handlers
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))  # updates buffered before backpressure
+WEBHOOK_WORKERS = max(1, int(os.getenv("WEBHOOK_WORKERS", 8)))  # dispatcher workers draining the queue
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", 0.5))  # seconds to wait for a free slot
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", 10000))  # recent update_ids remembered
+API_GLOBAL_RATE = float(os.getenv("API_GLOBAL_RATE", 30))  # Bot API requests/s across all chats
+API_PER_CHAT_RATE = float(os.getenv("API_PER_CHAT_RATE", 1))  # messages/s sent into one chat
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", 3))  # retries after TelegramRetryAfter
+CHANNEL_CACHE_SIZE = int(os.getenv("CHANNEL_CACHE_SIZE", 1024))  # usernames kept in memory
+CHANNEL_CACHE_TTL = int(os.getenv("CHANNEL_CACHE_TTL", 3600))  # seconds, in-memory hits
+CHANNEL_DB_TTL = int(os.getenv("CHANNEL_DB_TTL", 86400))  # seconds, Mongo `channels` entries
+CHANNEL_NEGATIVE_TTL = int(os.getenv("CHANNEL_NEGATIVE_TTL", 60))  # seconds, channels Telegram reports as not found
+CHECK_RETRY_DELAY = int(os.getenv("CHECK_RETRY_DELAY", 30))  # seconds before a task hit by a transient error is retried
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+LOG_TASK_SAMPLE = float(os.getenv("LOG_TASK_SAMPLE", 0.05))  # share of per-task INFO lines that are logged
 
 if not TOKEN or not MONGO_URI:
     raise SystemExit("ERROR: BOT_TOKEN and MONGO_URI must be set in environment or .env")
 
-bot = Bot(token=TOKEN)
+# -----------------------
+# Logging
+# -----------------------
+# Records are handed to a QueueHandler and written to stdout as JSON lines by a
+# listener thread, so the event loop never blocks on I/O. Per-task lines go to
+# the "gemad.task" logger and are sampled at LOG_TASK_SAMPLE below WARNING.
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update((k, v) for k, v in vars(record).items() if k not in _RECORD_ATTRS)
+        if record.exc_info:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class JsonQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # The stock prepare() runs the default formatter, which appends the
+        # traceback to msg and drops exc_info; keep it in exc_text instead so
+        # JsonFormatter can emit it as "exc".
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+class SampleFilter(logging.Filter):
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+_log_queue = queue.SimpleQueue()
+_log_output = logging.StreamHandler(sys.stdout)
+_log_output.setFormatter(JsonFormatter())
+log_listener = logging.handlers.QueueListener(_log_queue, _log_output)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+log = logging.getLogger("gemad")
+log.setLevel(LOG_LEVEL)
+log.addHandler(JsonQueueHandler(_log_queue))
+log.propagate = False
+task_log = logging.getLogger("gemad.task")
+task_log.addFilter(SampleFilter(LOG_TASK_SAMPLE))
+
+# -----------------------
+# Metrics
+# -----------------------
+# Minimal Prometheus text-format registry served from GET /metrics. Metrics are
+# updated from pymongo's monitoring threads as well as the event loop, hence
+# the lock.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+_metrics_lock = threading.Lock()
+METRICS = []
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labelnames=()):
+        self.name, self.doc, self.labelnames = name, doc, tuple(labelnames)
+        self.values = {}
+        METRICS.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with _metrics_lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield f"{self.name}{_labels(self.labelnames, key)} {value}"
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with _metrics_lock:
+            self.values[key] = value
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.doc, self.labelnames, self.buckets = name, doc, tuple(labelnames), buckets
+        self.values = {}
+        METRICS.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with _metrics_lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += 1
+            state[2] += value
+
+    def samples(self):
+        for key, (counts, count, total) in self.values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket{_labels(self.labelnames + ('le',), key + (bound,))} {bucket_count}"
+            yield f"{self.name}_bucket{_labels(self.labelnames + ('le',), key + ('+Inf',))} {count}"
+            yield f"{self.name}_sum{_labels(self.labelnames, key)} {total}"
+            yield f"{self.name}_count{_labels(self.labelnames, key)} {count}"
+
+def render_metrics() -> str:
+    lines = []
+    with _metrics_lock:
+        for metric in METRICS:
+            lines.append(f"# HELP {metric.name} {metric.doc}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+TASKS = Counter("gemad_tasks_total", "Checked tasks by outcome.", ["outcome"])
+PENDING_TASKS = Gauge("gemad_pending_tasks", "Tasks in pendings with status=waiting.")
+UPDATE_QUEUE_SIZE = Gauge("gemad_update_queue_size", "Webhook updates waiting for a dispatcher worker.")
+OUTBOX_PENDING = Gauge("gemad_outbox_pending", "Notifications waiting for delivery.")
+ITERATION_SECONDS = Histogram("gemad_iteration_duration_seconds", "Duration of one checker queue iteration.",
+                              buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300))
+API_SECONDS = Histogram("gemad_bot_api_request_duration_seconds", "Bot API request latency.", ["method"])
+API_ERRORS = Counter("gemad_bot_api_errors_total", "Failed Bot API requests.", ["method", "error"])
+MONGO_SECONDS = Histogram("gemad_mongo_command_duration_seconds", "MongoDB command latency.", ["command"])
+MONGO_ERRORS = Counter("gemad_mongo_command_errors_total", "Failed MongoDB commands.", ["command"])
+WEBHOOK_SECONDS = Histogram("gemad_webhook_duration_seconds", "Time spent answering a webhook request.", ["mode"])
+UPDATE_SECONDS = Histogram("gemad_update_handling_seconds", "Time spent handling one update in the dispatcher.")
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, command=event.command_name)
+        MONGO_ERRORS.inc(command=event.command_name)
+
+class ApiMetrics(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        api_method = getattr(method, "__api_method__", type(method).__name__)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            API_ERRORS.inc(method=api_method, error=type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - started, method=api_method)
+
+if TELEGRAM_API_URL:
+    bot = Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=TOKEN)
 dp = Dispatcher()
 app = FastAPI()
 
-mongo = AsyncIOMotorClient(MONGO_URI)
+mongo = AsyncIOMotorClient(MONGO_URI, event_listeners=[MongoCommandMetrics()])
 db = mongo["test"]
 pending = db["pendings"]
 users = db["users"]
+channels = db["channels"]
+rewards = db["rewards"]
+memberships = db["memberships"]
+outbox = db["outbox"]
+
+CHANGE_STREAM_UNSUPPORTED = 40573  # "$changeStream stage is only supported on replica sets"
 
 # -----------------------
 # Helpers
 # -----------------------
-def now_str():
-    return datetime.utcnow().isoformat()
+DUPLICATE_KEY = 11000
+
+def bulk_write_failures(e: BulkWriteError) -> dict:
+    return {err["index"]: (err.get("code"), err.get("errmsg")) for err in e.details.get("writeErrors", [])}
 
 async def safe_set_webhook(url: str, max_retries: int = 5):
     backoff = 1
     for attempt in range(1, max_retries + 1):
         try:
-            await bot.set_webhook(url)
-            print(f"[{now_str()}] ✅ Webhook set successfully: {url}")
+            # allowed_updates must list chat_member explicitly, Telegram omits it by default
+            await bot.set_webhook(url, allowed_updates=dp.resolve_used_update_types())
+            log.info("Webhook set", extra={"url": url})
             return True
         except Exception as e:
-            print(f"[{now_str()}] ⚠️ Attempt {attempt}/{max_retries} to set webhook failed: {e}")
+            log.warning("Setting webhook failed", extra={"attempt": attempt, "max_retries": max_retries, "error": str(e)})
             if "retry after" in str(e).lower() or "too many requests" in str(e).lower() or "flood" in str(e).lower():
                 await asyncio.sleep(backoff)
                 backoff = min(backoff * 2, 30)
             else:
                 await asyncio.sleep(backoff)
                 backoff = min(backoff * 2, 30)
-    print(f"[{now_str()}] ❌ Failed to set webhook after {max_retries} attempts")
+    log.error("Giving up on setting webhook", extra={"max_retries": max_retries})
     return False
 
+class TTLCache:
+    """Small LRU cache whose entries expire after a per-entry TTL."""
+
+    _MISS = object()
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def get(self, key, default=_MISS):
+        item = self.data.get(key)
+        if item is None:
+            return default
+        expires, value = item
+        if expires < time.monotonic():
+            del self.data[key]
+            return default
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float):
+        self.data[key] = (time.monotonic() + ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+channel_cache = TTLCache(CHANNEL_CACHE_SIZE)
+channel_inflight = {}
+
+class ChannelLookupError(Exception):
+    """get_chat failed for a reason other than the chat not existing."""
+
+def channel_cache_key(raw_channel) -> str:
+    return str(raw_channel).strip().lstrip("@").lower()
+
+async def _lookup_channel(raw_channel, key):
+    try:
+        doc = await channels.find_one({"_id": key})
+        if doc and doc.get("chatId") is not None:
+            if datetime.utcnow() - doc.get("resolvedAt", datetime.min) < timedelta(seconds=CHANNEL_DB_TTL):
+                channel_cache.set(key, int(doc["chatId"]), CHANNEL_CACHE_TTL)
+                return int(doc["chatId"])
+    except Exception as e:
+        log.warning("channels.find_one failed", extra={"channel": key, "error": str(e)})
+
+    candidates = [str(raw_channel).strip()]
+    if not str(raw_channel).startswith("@"):
+        candidates.append("@" + str(raw_channel).strip())
+
+    transient = None
+    for cand in candidates:
+        try:
+            chat = await bot.get_chat(cand)
+            log.info("Channel resolved", extra={"channel": cand, "chat_id": chat.id, "chat_type": chat.type, "title": getattr(chat, "title", None)})
+        except TelegramBadRequest as e:
+            log.warning("get_chat failed", extra={"channel": cand, "error": str(e)})
+            continue
+        except Exception as e:
+            # Network errors, 5xx, exhausted RetryAfter: says nothing about the channel.
+            log.warning("get_chat failed", extra={"channel": cand, "error": str(e)})
+            transient = e
+            continue
+        chat_id = int(chat.id)
+        channel_cache.set(key, chat_id, CHANNEL_CACHE_TTL)
+        try:
+            await channels.update_one(
+                {"_id": key},
+                {"$set": {"chatId": chat_id, "username": getattr(chat, "username", None), "resolvedAt": datetime.utcnow()}},
+                upsert=True
+            )
+        except Exception as e:
+            log.warning("channels.update_one failed", extra={"channel": key, "error": str(e)})
+        return chat_id
+
+    if transient is not None:
+        raise ChannelLookupError(str(transient)) from transient
+
+    # Remember the failure briefly so a typo'd channel can't hammer get_chat.
+    channel_cache.set(key, None, CHANNEL_NEGATIVE_TTL)
+    log.error("Could not resolve channel to chat_id", extra={"channel": raw_channel})
+    return None
+
 async def resolve_chat_id(raw_channel):
+    """Returns the chat id, or None if the channel does not exist; raises
+    ChannelLookupError when Telegram could not be asked."""
     if raw_channel is None:
         return None
     try:
@@ -66,111 +390,809 @@ async def resolve_chat_id(raw_channel):
     except Exception:
         pass
 
-    candidates = [str(raw_channel).strip()]
-    if not str(raw_channel).startswith("@"):
-        candidates.append("@" + str(raw_channel).strip())
+    key = channel_cache_key(raw_channel)
+    cached = channel_cache.get(key)
+    if cached is not TTLCache._MISS:
+        return cached
 
-    for cand in candidates:
+    # Concurrent lookups for the same username share one in-flight request.
+    fut = channel_inflight.get(key)
+    if fut is None:
+        fut = asyncio.ensure_future(_lookup_channel(raw_channel, key))
+        channel_inflight[key] = fut
+        fut.add_done_callback(lambda _: channel_inflight.pop(key, None))
+    return await asyncio.shield(fut)
+
+# -----------------------
+# Bot API rate limiting
+# -----------------------
+# Methods that post into a chat are subject to Telegram's per-chat limit
+# (~1 message/s); everything else only counts against the global budget.
+SEND_METHOD_PREFIXES = ("send", "copy", "forward")
+MAX_CHAT_BUCKETS = 10000
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        now = time.monotonic()
+        refilled = self.tokens + (now - self.updated) * self.rate
+        return now >= self.paused_until and refilled >= self.capacity and not self.lock.locked()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class ApiRateLimiter(BaseRequestMiddleware):
+    """Token-bucket limiter for every outgoing Bot API request.
+
+    A request takes a token from its chat bucket (if the method targets a chat)
+    and then from the global bucket. On TelegramRetryAfter only the bucket the
+    request was charged to is paused, so other chats keep flowing.
+    """
+
+    def __init__(self, global_rate: float, per_chat_rate: float, max_retries: int):
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_rate = per_chat_rate
+        self.max_retries = max_retries
+        self.chat_buckets = OrderedDict()
+
+    def _chat_bucket(self, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return None
+        api_method = getattr(method, "__api_method__", type(method).__name__)
+        sending = api_method.startswith(SEND_METHOD_PREFIXES)
+        key = (str(chat_id), sending)
+        bucket = self.chat_buckets.get(key)
+        if bucket is None:
+            if len(self.chat_buckets) >= MAX_CHAT_BUCKETS:
+                for old_key in [k for k, b in self.chat_buckets.items() if b.idle()]:
+                    del self.chat_buckets[old_key]
+                while len(self.chat_buckets) >= MAX_CHAT_BUCKETS:
+                    self.chat_buckets.popitem(last=False)
+            # Non-sending methods get a per-chat bucket too, only so that a
+            # RetryAfter on one channel can be paused without stalling the rest.
+            bucket = TokenBucket(self.per_chat_rate if sending else self.global_bucket.rate)
+            self.chat_buckets[key] = bucket
+        else:
+            self.chat_buckets.move_to_end(key)
+        return bucket
+
+    async def __call__(self, make_request, bot, method):
+        attempt = 0
+        while True:
+            chat_bucket = self._chat_bucket(method)
+            if chat_bucket is not None:
+                await chat_bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                bucket = chat_bucket or self.global_bucket
+                bucket.pause(e.retry_after)
+                log.warning("Bot API asked to retry later", extra={
+                    "method": type(method).__name__, "retry_after": e.retry_after,
+                    "chat_id": getattr(method, "chat_id", None), "attempt": attempt, "max_retries": self.max_retries
+                })
+                if attempt > self.max_retries:
+                    raise
+
+api_limiter = ApiRateLimiter(API_GLOBAL_RATE, API_PER_CHAT_RATE, API_MAX_RETRIES)
+bot.session.middleware(api_limiter)
+# Registered after the limiter, so it wraps only the HTTP request itself.
+bot.session.middleware(ApiMetrics())
+
+async def ensure_indexes():
+    await pending.create_index([("status", 1), ("checkAfter", 1)])
+    await pending.create_index([("leaseToken", 1)], sparse=True)
+    await pending.create_index([("telegramId", 1), ("status", 1)])
+    await users.create_index([("telegramId", 1)])
+    await channels.create_index([("chatId", 1)])
+    await outbox.create_index([("status", 1), ("nextAttemptAt", 1)])
+    await outbox.create_index([("leaseToken", 1)], sparse=True)
+
+# -----------------------
+# Task leases
+# -----------------------
+# A worker owns a task while `leaseUntil` is in the future. Claims are made
+# per chunk: candidate ids are read, then stamped with a fresh leaseToken by
+# one update_many whose filter re-checks claimability, so each document is
+# claimed atomically by exactly one worker. Expired leases are claimable again.
+LEASE_FIELDS = {"leaseOwner": "", "leaseToken": "", "leaseUntil": ""}
+
+async def claim_leased(collection, filter: dict, limit: int, projection=None):
+    """Lease up to `limit` documents matching `filter`; returns (token, docs)."""
+    now = datetime.utcnow()
+    claimable = {**filter, "$or": [{"leaseUntil": None}, {"leaseUntil": {"$lte": now}}]}
+    candidates = await collection.find(claimable, {"_id": 1}).limit(limit).to_list(length=limit)
+    if not candidates:
+        return None, []
+    token = uuid.uuid4().hex
+    await collection.update_many(
+        {"_id": {"$in": [c["_id"] for c in candidates]}, **claimable},
+        {"$set": {"leaseOwner": WORKER_ID, "leaseToken": token, "leaseUntil": now + timedelta(seconds=LEASE_SECONDS)}}
+    )
+    docs = await collection.find({"leaseToken": token}, projection).to_list(length=limit)
+    return token, docs
+
+async def claim_tasks(limit: int):
+    now = datetime.utcnow()
+    return await claim_leased(pending, {"status": "waiting", "checkAfter": {"$lte": now}}, limit, TASK_PROJECTION)
+
+async def renew_lease(token: str, collection=None):
+    collection = pending if collection is None else collection
+    while True:
+        await asyncio.sleep(LEASE_SECONDS / 3)
         try:
-            chat = await bot.get_chat(cand)
-            print(f"[{now_str()}] ℹ️ get_chat('{cand}') -> id={chat.id}, type={chat.type}, title={getattr(chat,'title',None)}")
-            return int(chat.id)
+            await collection.update_many(
+                {"leaseToken": token},
+                {"$set": {"leaseUntil": datetime.utcnow() + timedelta(seconds=LEASE_SECONDS)}}
+            )
         except Exception as e:
-            print(f"[{now_str()}] ⚠️ get_chat('{cand}') failed: {e}")
+            log.warning("Failed to renew lease", extra={"lease_token": token, "error": str(e)})
 
-    print(f"[{now_str()}] ❌ Could not resolve channel '{raw_channel}' to chat_id")
-    return None
+# -----------------------
+# Membership index
+# -----------------------
+# Where the bot is an admin of a channel Telegram pushes chat_member updates,
+# which are stored in `memberships` keyed by "<chat_id>:<user_id>". Pushed and
+# polled observations live in separate fields: pushed ones are ordered by
+# Telegram's (date, update_id), polled ones by our own clock. The checker
+# trusts the pushed status for channels with pushEnabled when it arrived after
+# the bot's current admin period began (`pushSince`) and is younger than
+# MEMBERSHIP_PUSH_TTL, since a lost leave event (queued update dropped on
+# restart, failed write) would otherwise count the user in forever. A polled
+# status is trusted only as a positive answer younger than MEMBERSHIP_TTL,
+# and otherwise get_chat_member is called.
+MEMBER_STATUSES = ("member", "administrator", "creator", "owner")
+
+def member_status(member):
+    status = getattr(member, "status", None)
+    if status is None:
+        return None
+    return str(getattr(status, "value", status)).lower()
+
+def membership_key(chat_id, user_id) -> str:
+    return f"{chat_id}:{user_id}"
+
+# Both upserts apply only if nothing newer is stored; a newer entry makes the
+# upsert collide on _id, which callers treat as a stale observation.
+def pushed_membership(chat_id: int, user_id: int, status: str, event_date: datetime, update_id: int) -> UpdateOne:
+    # event.date has one-second resolution; update_id breaks ties within a second.
+    newer = {"$or": [
+        {"pushDate": None},
+        {"pushDate": {"$lt": event_date}},
+        {"pushDate": event_date, "pushUpdateId": {"$lt": update_id}},
+    ]}
+    return UpdateOne(
+        {"_id": membership_key(chat_id, user_id), **newer},
+        {"$set": {"chatId": chat_id, "userId": user_id, "pushStatus": status, "pushDate": event_date,
+                  "pushUpdateId": update_id, "pushedAt": datetime.utcnow()}},
+        upsert=True
+    )
+
+def polled_membership(chat_id: int, user_id: int, status: str) -> UpdateOne:
+    now = datetime.utcnow()
+    return UpdateOne(
+        {"_id": membership_key(chat_id, user_id), "$or": [{"polledAt": None}, {"polledAt": {"$lt": now}}]},
+        {"$set": {"chatId": chat_id, "userId": user_id, "pollStatus": status, "polledAt": now}},
+        upsert=True
+    )
+
+def only_stale_memberships(e: BulkWriteError) -> bool:
+    return all(code == DUPLICATE_KEY for code, _ in bulk_write_failures(e).values())
+
+def channel_task_values(chat) -> list:
+    """Values a task's `channel` field may hold for this chat."""
+    values = [chat.id, str(chat.id)]
+    if chat.username:
+        values += [chat.username, "@" + chat.username, chat.username.lower(), "@" + chat.username.lower()]
+    return values
 
 # -----------------------
-# Main queue processing logic
+# Notification outbox
 # -----------------------
-async def process_queue_iteration():
+# Reward notifications are written to `outbox` next to the reward itself and
+# delivered by NotificationSender, so the checker never waits on send_message.
+# Documents move pending -> sent, or pending -> failed after a permanent error
+# or OUTBOX_MAX_ATTEMPTS tries; retries are scheduled through nextAttemptAt.
+async def queue_notifications(messages):
+    """messages: iterable of (key, chat_id, text); the key makes the insert idempotent."""
     now = datetime.utcnow()
-    print(f"[{now_str()}] 🔄 Queue iteration started (now={now.isoformat()})")
+    docs = [
+        {"_id": key, "chatId": chat_id, "text": text, "status": "pending", "attempts": 0,
+         "createdAt": now, "nextAttemptAt": now}
+        for key, chat_id, text in messages
+    ]
+    try:
+        await outbox.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != DUPLICATE_KEY]
+        if errors:
+            log.warning("Notifications not queued", extra={"failed": len(errors), "total": len(docs), "error": errors[0].get("errmsg")})
+    except Exception as e:
+        log.warning("Failed to queue notifications", extra={"total": len(docs), "error": str(e)})
+    notifier.wake.set()
 
-    cursor = pending.find({"status": "waiting", "checkAfter": {"$lte": now}})
-    async for task in cursor:
-        tid = str(task.get("_id"))
-        telegram_id_raw = task.get("telegramId")
-        channel_raw = task.get("channel")
-        reward = int(task.get("reward", 15))
+class NotificationSender:
+    def __init__(self):
+        self.wake = asyncio.Event()
+        # Paced below the global Bot API budget, one token at a time, so a
+        # round of notifications never queues ahead of interactive replies.
+        self.bucket = TokenBucket(API_GLOBAL_RATE * OUTBOX_RATE_SHARE, capacity=1)
 
-        print(f"[{now_str()}] ▶ Task {tid}: telegramId={telegram_id_raw!r}, channel={channel_raw!r}, reward={reward}")
+    async def claim(self):
+        now = datetime.utcnow()
+        return await claim_leased(outbox, {"status": "pending", "nextAttemptAt": {"$lte": now}}, OUTBOX_BATCH_SIZE)
 
+    async def deliver(self, doc, token: str) -> UpdateOne:
+        leased = {"_id": doc["_id"], "leaseToken": token}
+        attempts = doc.get("attempts", 0) + 1
         try:
-            user_id = int(str(telegram_id_raw).strip())
+            await self.bucket.acquire()
+            await bot.send_message(doc["chatId"], doc["text"])
+            task_log.info("Notification sent", extra={"user_id": doc["chatId"]})
+            return UpdateOne(leased, {"$set": {"status": "sent", "sentAt": datetime.utcnow(), "attempts": attempts}, "$unset": LEASE_FIELDS})
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Blocked bot, deleted account, chat not found: retrying won't help.
+            log.warning("Notification failed permanently", extra={"user_id": doc["chatId"], "error": str(e)})
+            return UpdateOne(leased, {"$set": {"status": "failed", "lastError": str(e), "attempts": attempts}, "$unset": LEASE_FIELDS})
         except Exception as e:
-            print(f"[{now_str()}] ❌ Invalid telegramId in task {tid}: {telegram_id_raw!r} — marked as failed ({e})")
-            await pending.update_one({"_id": task["_id"]}, {"$set": {"status": "failed", "error": "invalid telegramId"}})
-            continue
-
-        chat_id = await resolve_chat_id(channel_raw)
-        if chat_id is None:
-            await pending.update_one({"_id": task["_id"]}, {"$set": {"status": "failed", "error": "channel_resolve_failed"}})
-            print(f"[{now_str()}] ❌ Task {tid}: channel resolution failed, marked failed")
-            continue
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                log.warning("Notification failed, giving up", extra={"user_id": doc["chatId"], "attempts": attempts, "error": str(e)})
+                return UpdateOne(leased, {"$set": {"status": "failed", "lastError": str(e), "attempts": attempts}, "$unset": LEASE_FIELDS})
+            delay = min(2 ** attempts, OUTBOX_BACKOFF_MAX)
+            if isinstance(e, TelegramRetryAfter):
+                delay = max(delay, e.retry_after)
+            log.warning("Notification failed, will retry", extra={"user_id": doc["chatId"], "attempts": attempts, "retry_in": delay, "error": str(e)})
+            return UpdateOne(leased, {
+                "$set": {"lastError": str(e), "attempts": attempts, "nextAttemptAt": datetime.utcnow() + timedelta(seconds=delay)},
+                "$unset": LEASE_FIELDS
+            })
 
+    async def send_round(self) -> int:
+        token, docs = await self.claim()
+        if not docs:
+            return 0
+        renewer = asyncio.create_task(renew_lease(token, outbox))
+        try:
+            # Sends are paced by self.bucket, then by the Bot API rate limiter.
+            ops = await asyncio.gather(*(self.deliver(doc, token) for doc in docs))
+        finally:
+            renewer.cancel()
         try:
-            user_doc = await users.find_one({"telegramId": str(user_id)})
-            if user_doc:
-                subs = user_doc.get("subscribedChannels", [])
-                if str(chat_id) in [str(s) for s in subs]:
-                    print(f"[{now_str()}] ℹ️ Task {tid}: user {user_id} already subscribed -> skipped")
-                    await pending.update_one({"_id": task["_id"]}, {"$set": {"status": "skipped"}})
+            await outbox.bulk_write(ops, ordered=False)
+        except Exception as e:
+            log.error("Error recording notification delivery state", extra={"total": len(ops), "error": str(e)})
+        return len(docs)
+
+    async def run(self):
+        while True:
+            try:
+                if await self.send_round():
                     continue
+            except Exception:
+                log.exception("Error in notification sender")
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+
+notifier = NotificationSender()
+
+# -----------------------
+# Main queue processing logic
+# -----------------------
+TASK_PROJECTION = {"telegramId": 1, "channel": 1, "reward": 1}
+
+class CheckBatch:
+    """One chunk of due tasks.
+
+    Users and channel ids are prefetched for the whole chunk, and every status
+    transition, reward and delete is collected here and written with unordered
+    bulk_write calls in flush(). flush() runs every CHECK_FLUSH_INTERVAL or
+    CHECK_FLUSH_SIZE grants while the chunk is processed, and once at the end.
+    """
+
+    def __init__(self, tasks, lease_token: str):
+        self.tasks = tasks
+        self.lease_token = lease_token
+        self.chat_ids = {}
+        self.unreachable_channels = set()
+        self.subscribed = {}
+        self.granting = {}
+        self.pending_ops = []
+        self.rewards = []
+        self.push_chats = {}
+        self.memberships = {}
+        self.membership_ops = []
+        self.flush_lock = asyncio.Lock()
+        self.flush_due = asyncio.Event()
+
+    def leased(self, task) -> dict:
+        # Writes only apply while we still hold the lease on the task.
+        return {"_id": task["_id"], "leaseToken": self.lease_token}
+
+    def fail(self, task, **fields):
+        TASKS.inc(outcome="failed")
+        self.pending_ops.append(UpdateOne(self.leased(task), {"$set": {"status": "failed", **fields}, "$unset": LEASE_FIELDS}))
+
+    def retry(self, task):
+        # Back to waiting without a lease; picked up again after CHECK_RETRY_DELAY.
+        TASKS.inc(outcome="retried")
+        self.pending_ops.append(UpdateOne(self.leased(task), {
+            "$set": {"checkAfter": datetime.utcnow() + timedelta(seconds=CHECK_RETRY_DELAY)},
+            "$unset": LEASE_FIELDS
+        }))
+
+    def skip(self, task):
+        TASKS.inc(outcome="skipped")
+        self.pending_ops.append(UpdateOne(self.leased(task), {"$set": {"status": "skipped"}, "$unset": LEASE_FIELDS}))
+
+    def already_subscribed(self, user_id: int, chat_id: int) -> bool:
+        return str(chat_id) in self.subscribed.get(str(user_id), ())
+
+    def wait_for_grant(self, task, user_id: int, chat_id: int) -> bool:
+        """Parks a task behind an unwritten grant for the same user/channel;
+        it is skipped once that reward is paid and retried if paying fails."""
+        siblings = self.granting.get((str(user_id), str(chat_id)))
+        if siblings is None:
+            return False
+        siblings.append(task)
+        return True
+
+    def settle_grant(self, user_id, chat_id, paid: bool):
+        siblings = self.granting.pop((str(user_id), str(chat_id)), [])
+        if paid:
+            self.subscribed.setdefault(str(user_id), set()).add(str(chat_id))
+        for task in siblings:
+            if paid:
+                self.skip(task)
+            else:
+                self.retry(task)
+
+    def indexed_status(self, chat_id: int, user_id: int):
+        entry = self.memberships.get(membership_key(chat_id, user_id))
+        if not entry:
+            return None
+        now = datetime.utcnow()
+        push_since = self.push_chats.get(chat_id)
+        pushed_at = entry.get("pushedAt", datetime.min)
+        if entry.get("pushStatus") and push_since and pushed_at >= push_since and now - pushed_at < timedelta(seconds=MEMBERSHIP_PUSH_TTL):
+            return entry["pushStatus"]
+        fresh = now - entry.get("polledAt", datetime.min) < timedelta(seconds=MEMBERSHIP_TTL)
+        if fresh and entry.get("pollStatus") in MEMBER_STATUSES:
+            return entry["pollStatus"]
+        return None
+
+    def remember_membership(self, chat_id: int, user_id: int, status: str):
+        self.membership_ops.append(polled_membership(chat_id, user_id, status))
+
+    def grant(self, task, user_id: int, chat_id: int, reward: int):
+        # Recorded immediately so a second task for the same user/channel in
+        # this chunk waits for this one, as it did in the sequential loop.
+        self.granting[(str(user_id), str(chat_id))] = []
+        self.rewards.append((task, user_id, chat_id, reward))
+        if len(self.rewards) >= CHECK_FLUSH_SIZE:
+            self.flush_due.set()
+
+    async def prefetch(self):
+        raw_channels = {str(t.get("channel")): t.get("channel") for t in self.tasks if t.get("channel") is not None}
+        keys = list(raw_channels)
+        resolved = await asyncio.gather(*(resolve_chat_id(raw_channels[k]) for k in keys), return_exceptions=True)
+        for k, chat_id in zip(keys, resolved):
+            if isinstance(chat_id, Exception):
+                self.unreachable_channels.add(k)
+                chat_id = None
+            self.chat_ids[k] = chat_id
+
+        telegram_ids = list({str(t.get("telegramId")).strip() for t in self.tasks})
+        try:
+            async for doc in users.find({"telegramId": {"$in": telegram_ids}}, {"telegramId": 1, "subscribedChannels": 1}):
+                subs = self.subscribed.setdefault(str(doc.get("telegramId")), set())
+                subs.update(str(s) for s in doc.get("subscribedChannels", []))
         except Exception as e:
-            print(f"[{now_str()}] ⚠️ Error reading users for task {tid}: {e}")
+            log.warning("Error prefetching users", extra={"total": len(telegram_ids), "error": str(e)})
 
+        chat_ids = list({c for c in self.chat_ids.values() if c is not None})
+        keys = list({
+            membership_key(self.chat_ids.get(str(t.get("channel"))), str(t.get("telegramId")).strip())
+            for t in self.tasks if self.chat_ids.get(str(t.get("channel"))) is not None
+        })
         try:
-            member = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
-            status_enum = getattr(member, "status", None)
-            status_str = status_enum.value.lower() if status_enum else None
-            print(f"[{now_str()}] ℹ️ Task {tid}: get_chat_member(chat_id={chat_id}, user_id={user_id}) -> status={status_str}")
+            async for doc in channels.find({"chatId": {"$in": chat_ids}, "pushEnabled": True}, {"chatId": 1, "pushSince": 1}):
+                if doc.get("pushSince"):
+                    self.push_chats[int(doc["chatId"])] = doc["pushSince"]
+            async for doc in memberships.find({"_id": {"$in": keys}}):
+                self.memberships[doc["_id"]] = doc
         except Exception as e:
-            print(f"[{now_str()}] ⚠️ Error get_chat_member for task {tid}, chat_id={chat_id}, user_id={user_id}: {e}")
-            await pending.update_one({"_id": task["_id"]}, {"$set": {"status": "failed", "error": f"get_chat_member_error: {str(e)}"}})
-            continue
+            log.warning("Error prefetching memberships", extra={"error": str(e)})
+
+    async def flush(self):
+        async with self.flush_lock:
+            return await self._flush()
 
-        if status_str in ("member", "administrator", "creator", "owner"):
+    async def _flush(self):
+        # Workers keep collecting into fresh lists while these are written.
+        collected, self.rewards = self.rewards, []
+        granted = []
+        if collected:
+            # Paying is a single update per task: the $inc only applies while the
+            # task id is not yet in the user's `rewardedTasks`, and it is pushed
+            # there in the same update. A task reclaimed after a crash or a
+            # lapsed lease therefore can never be paid twice. That filter can't
+            # upsert safely (a paid task would insert a second user doc), so
+            # missing users are created first.
+            failed = {}
+            user_ids = list({str(user_id) for _, user_id, _, _ in collected})
             try:
-                res = await users.update_one(
-                    {"telegramId": str(user_id)},
-                    {
-                        "$inc": {"balance": reward, "totalEarned": reward},
-                        "$addToSet": {"subscribedChannels": str(chat_id)}
-                    },
-                    upsert=True
-                )
-                print(f"[{now_str()}] ✅ Task {tid}: reward granted (mongo modified={getattr(res,'modified_count',None)})")
+                await users.bulk_write([
+                    UpdateOne({"telegramId": uid}, {"$setOnInsert": {"balance": 0, "totalEarned": 0}}, upsert=True)
+                    for uid in user_ids
+                ], ordered=False)
+            except BulkWriteError as e:
+                missing = {user_ids[i] for i in bulk_write_failures(e)}
+                failed = {i: (None, "user upsert failed") for i, r in enumerate(collected) if str(r[1]) in missing}
+            except Exception as e:
+                failed = {i: (None, str(e)) for i in range(len(collected))}
+
+            fresh = []
+            for i, (task, user_id, chat_id, reward) in enumerate(collected):
+                if i in failed:
+                    # Paying is idempotent per task id, so a failed write is retried.
+                    task_log.warning("Reward write failed, task retried later", extra={"task_id": str(task["_id"]), "error": failed[i][1]})
+                    self.retry(task)
+                    self.settle_grant(user_id, chat_id, paid=False)
+                else:
+                    fresh.append((task, user_id, chat_id, reward))
+
+            failed = {}
+            if fresh:
+                user_ops = [
+                    UpdateOne(
+                        {"telegramId": str(user_id), "rewardedTasks": {"$ne": str(task["_id"])}},
+                        {
+                            "$inc": {"balance": reward, "totalEarned": reward},
+                            "$addToSet": {"subscribedChannels": str(chat_id), "rewardedTasks": str(task["_id"])}
+                        }
+                    )
+                    for task, user_id, chat_id, reward in fresh
+                ]
                 try:
-                    await bot.send_message(user_id, f"🎉 You were subscribed and earned {reward}⭐!")
-                    print(f"[{now_str()}] ℹ️ Notification sent to user {user_id}")
-                except Exception as e_send:
-                    print(f"[{now_str()}] ⚠️ Failed to notify user {user_id}: {e_send}")
+                    res = await users.bulk_write(user_ops, ordered=False)
+                    # Unmatched updates are tasks an earlier claim already paid.
+                    log.info("Rewards granted", extra={"total": len(user_ops), "modified": res.modified_count})
+                except BulkWriteError as e:
+                    failed = bulk_write_failures(e)
+                    log.warning("Reward updates failed", extra={"failed": len(failed), "total": len(user_ops)})
+                except Exception as e:
+                    failed = {i: (None, str(e)) for i in range(len(user_ops))}
+                    log.error("Error granting rewards", extra={"total": len(user_ops), "error": str(e)})
+
+            granted_at = datetime.utcnow()
+            ledger = []
+            for i, (task, user_id, chat_id, reward) in enumerate(fresh):
+                self.settle_grant(user_id, chat_id, paid=i not in failed)
+                if i in failed:
+                    task_log.warning("Reward write failed, task retried later", extra={"task_id": str(task["_id"]), "error": failed[i][1]})
+                    self.retry(task)
+                else:
+                    # ✅ Remove rewarded task from DB
+                    self.pending_ops.append(DeleteOne(self.leased(task)))
+                    granted.append((task, user_id, reward))
+                    ledger.append({"_id": str(task["_id"]), "telegramId": str(user_id), "chatId": str(chat_id),
+                                   "reward": reward, "grantedAt": granted_at, "worker": WORKER_ID})
+            TASKS.inc(len(granted), outcome="rewarded")
+
+            if ledger:
+                # Audit trail keyed by task id; a re-run of a paid task collides on _id.
+                try:
+                    await rewards.insert_many(ledger, ordered=False)
+                except BulkWriteError as e:
+                    errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != DUPLICATE_KEY]
+                    if errors:
+                        log.warning("Error recording rewards", extra={"failed": len(errors), "total": len(ledger), "error": errors[0].get("errmsg")})
+                except Exception as e:
+                    log.warning("Error recording rewards", extra={"total": len(ledger), "error": str(e)})
+
+                await queue_notifications([
+                    (f"reward:{task['_id']}", user_id, f"🎉 You were subscribed and earned {reward}⭐!")
+                    for task, user_id, reward in granted
+                ])
 
-                # ✅ Remove rewarded task from DB
-                await pending.delete_one({"_id": task["_id"]})
-                print(f"[{now_str()}] 🗑️ Task {tid} removed from DB (rewarded)")
+        membership_ops, self.membership_ops = self.membership_ops, []
+        if membership_ops:
+            try:
+                await memberships.bulk_write(membership_ops, ordered=False)
+            except BulkWriteError as e:
+                if not only_stale_memberships(e):
+                    log.warning("Error caching memberships", extra={"total": len(membership_ops), "error": str(e)})
+            except Exception as e:
+                log.warning("Error caching memberships", extra={"total": len(membership_ops), "error": str(e)})
 
+        # Taken last so the deletes and failures queued above go out with it.
+        pending_ops, self.pending_ops = self.pending_ops, []
+        if pending_ops:
+            try:
+                await pending.bulk_write(pending_ops, ordered=False)
+                log.info("Task updates written", extra={"total": len(pending_ops), "rewarded": len(granted)})
             except Exception as e:
-                print(f"[{now_str()}] ❌ Error updating users/pending for task {tid}: {e}")
-                await pending.update_one({"_id": task["_id"]}, {"$set": {"status": "failed", "error": f"mongo_update_error: {e}"}})
-        else:
-            print(f"[{now_str()}] ❌ Task {tid}: user {user_id} not a member ({status_str}) — marked failed")
-            await pending.update_one({"_id": task["_id"]}, {"$set": {"status": "failed", "memberStatus": str(status_enum)}})
+                log.error("Error writing task updates", extra={"total": len(pending_ops), "error": str(e)})
+        return granted
+
+async def process_task(task, batch: CheckBatch):
+    tid = str(task.get("_id"))
+    telegram_id_raw = task.get("telegramId")
+    channel_raw = task.get("channel")
+    reward = int(task.get("reward", 15))
+
+    task_log.info("Checking task", extra={"task_id": tid, "telegram_id": telegram_id_raw, "channel": channel_raw, "reward": reward})
+
+    try:
+        user_id = int(str(telegram_id_raw).strip())
+    except Exception as e:
+        task_log.warning("Invalid telegramId, task failed", extra={"task_id": tid, "telegram_id": telegram_id_raw, "error": str(e)})
+        batch.fail(task, error="invalid telegramId")
+        return
+
+    chat_id = batch.chat_ids.get(str(channel_raw))
+    if chat_id is None and str(channel_raw) in batch.unreachable_channels:
+        task_log.warning("Channel lookup failed, task retried later", extra={"task_id": tid, "channel": channel_raw})
+        batch.retry(task)
+        return
+    if chat_id is None:
+        batch.fail(task, error="channel_resolve_failed")
+        task_log.warning("Channel resolution failed, task failed", extra={"task_id": tid, "channel": channel_raw})
+        return
+
+    if batch.already_subscribed(user_id, chat_id):
+        task_log.info("User already subscribed, task skipped", extra={"task_id": tid, "user_id": user_id, "chat_id": chat_id})
+        batch.skip(task)
+        return
+    if batch.wait_for_grant(task, user_id, chat_id):
+        task_log.info("Reward for this user/channel in flight, task waits for it", extra={"task_id": tid, "user_id": user_id, "chat_id": chat_id})
+        return
+
+    status_str = batch.indexed_status(chat_id, user_id)
+    if status_str is not None:
+        task_log.info("Membership from index", extra={"task_id": tid, "user_id": user_id, "chat_id": chat_id, "status": status_str})
+    else:
+        try:
+            member = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
+            status_str = member_status(member)
+            task_log.info("Membership from get_chat_member", extra={"task_id": tid, "user_id": user_id, "chat_id": chat_id, "status": status_str})
+        except Exception as e:
+            task_log.warning("get_chat_member failed, task failed", extra={"task_id": tid, "user_id": user_id, "chat_id": chat_id, "error": str(e)})
+            batch.fail(task, error=f"get_chat_member_error: {str(e)}")
+            return
+        batch.remember_membership(chat_id, user_id, status_str)
+
+    if status_str in MEMBER_STATUSES:
+        if batch.already_subscribed(user_id, chat_id):
+            task_log.info("User already rewarded in this batch, task skipped", extra={"task_id": tid, "user_id": user_id, "chat_id": chat_id})
+            batch.skip(task)
+            return
+        if batch.wait_for_grant(task, user_id, chat_id):
+            task_log.info("Reward for this user/channel in flight, task waits for it", extra={"task_id": tid, "user_id": user_id, "chat_id": chat_id})
+            return
+        batch.grant(task, user_id, chat_id, reward)
+    else:
+        task_log.info("User is not a member, task failed", extra={"task_id": tid, "user_id": user_id, "chat_id": chat_id, "status": status_str})
+        batch.fail(task, memberStatus=status_str)
+
+async def process_batch(tasks, lease_token: str):
+    batch = CheckBatch(tasks, lease_token)
+    renewer = asyncio.create_task(renew_lease(lease_token))
+    try:
+        await process_claimed(batch)
+        # The final flush is the largest write; keep the lease alive through it.
+        await batch.flush()
+    finally:
+        renewer.cancel()
+
+async def process_claimed(batch: CheckBatch):
+    tasks = batch.tasks
+    await batch.prefetch()
 
-    print(f"[{now_str()}] ⏱ Queue iteration finished")
+    queue = asyncio.Queue()
+    for task in tasks:
+        queue.put_nowait(task)
+
+    async def worker():
+        while not queue.empty():
+            task = queue.get_nowait()
+            try:
+                await process_task(task, batch)
+            except Exception:
+                log.exception("Unhandled error in task", extra={"task_id": str(task.get("_id"))})
+
+    done = False
+
+    async def flusher():
+        # Rewards go out while the rest of the chunk is still being checked,
+        # instead of all of them waiting for the slowest task.
+        while not done:
+            try:
+                await asyncio.wait_for(batch.flush_due.wait(), timeout=CHECK_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            batch.flush_due.clear()
+            if not done and (batch.rewards or batch.pending_ops):
+                try:
+                    await batch.flush()
+                except Exception:
+                    log.exception("Error flushing check batch")
+
+    flushing = asyncio.create_task(flusher())
+    try:
+        await asyncio.gather(*(worker() for _ in range(min(CHECK_CONCURRENCY, len(tasks)))))
+    finally:
+        done = True
+        batch.flush_due.set()
+        await flushing
+
+async def process_queue_iteration():
+    started = time.perf_counter()
+    log.debug("Queue iteration started", extra={"worker": WORKER_ID, "concurrency": CHECK_CONCURRENCY})
+
+    processed = 0
+    while True:
+        lease_token, tasks = await claim_tasks(CHECK_BATCH_SIZE)
+        if not tasks:
+            break
+        await process_batch(tasks, lease_token)
+        processed += len(tasks)
+
+    elapsed = time.perf_counter() - started
+    ITERATION_SECONDS.observe(elapsed)
+    log.info("Queue iteration finished", extra={"tasks": processed, "duration": round(elapsed, 3)})
+    return processed
 
 # -----------------------
 # Background loop
 # -----------------------
-async def background_checker():
-    while True:
+class DueScheduler:
+    """Wakes the checker exactly when the next `checkAfter` comes due.
+
+    Upcoming due times are kept in a min-heap. New and rescheduled tasks arrive
+    through a change stream on `pendings`; when the deployment has no change
+    streams (standalone mongod) the scheduler polls instead, backing off from
+    POLL_MIN_INTERVAL up to CHECK_INTERVAL while nothing new shows up.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.known_ids = set()
+        self.wake = asyncio.Event()
+        self.running = False
+        self.watching = False
+        self.poll_interval = POLL_MIN_INTERVAL
+        self.last_resync = 0.0
+
+    def schedule(self, when: datetime, task_id):
+        earliest = not self.heap or when < self.heap[0][0]
+        heapq.heappush(self.heap, (when, str(task_id)))
+        if earliest:
+            self.wake.set()
+
+    async def resync(self) -> int:
+        """Reload the earliest waiting tasks; returns how many were not seen before."""
+        cursor = pending.find({"status": "waiting"}, {"checkAfter": 1}).sort("checkAfter", 1).limit(SCHEDULER_PRELOAD)
+        docs = await cursor.to_list(length=SCHEDULER_PRELOAD)
+        ids = {str(d["_id"]) for d in docs}
+        new = len(ids - self.known_ids)
+        self.known_ids = ids
+        self.heap = [(d["checkAfter"], str(d["_id"])) for d in docs if isinstance(d.get("checkAfter"), datetime)]
+        heapq.heapify(self.heap)
+        self.last_resync = time.monotonic()
+        return new
+
+    def pop_due(self) -> int:
+        now = datetime.utcnow()
+        due = 0
+        while self.heap and self.heap[0][0] <= now:
+            heapq.heappop(self.heap)
+            due += 1
+        return due
+
+    def next_delay(self) -> float:
+        if self.watching:
+            delay = max(0.0, SCHEDULER_RESYNC - (time.monotonic() - self.last_resync))
+        else:
+            delay = self.poll_interval
+        if self.heap:
+            until_due = (self.heap[0][0] - datetime.utcnow()).total_seconds()
+            delay = min(delay, max(0.0, until_due))
+        return delay
+
+    async def watch(self):
+        pipeline = [{"$match": {"$or": [
+            {"operationType": {"$in": ["insert", "replace"]}},
+            {"updateDescription.updatedFields.checkAfter": {"$exists": True}},
+            {"updateDescription.updatedFields.status": "waiting"},
+        ]}}]
+        while True:
+            try:
+                async with pending.watch(pipeline, full_document="updateLookup") as stream:
+                    self.watching = True
+                    # Reload once the stream is open so nothing inserted before it is missed.
+                    self.last_resync = 0.0
+                    self.wake.set()
+                    log.info("Watching pendings change stream")
+                    async for change in stream:
+                        doc = change.get("fullDocument") or {}
+                        if doc.get("status") == "waiting" and isinstance(doc.get("checkAfter"), datetime):
+                            self.schedule(doc["checkAfter"], doc["_id"])
+            except (NotImplementedError, OperationFailure) as e:
+                if isinstance(e, OperationFailure) and e.code != CHANGE_STREAM_UNSUPPORTED:
+                    log.warning("Change stream failed, polling until it is reopened", extra={"error": str(e)})
+                else:
+                    log.info("Change streams not supported, falling back to polling")
+                    self.watching = False
+                    return
+            except Exception as e:
+                log.warning("Change stream failed, polling until it is reopened", extra={"error": str(e)})
+            self.watching = False
+            self.wake.set()
+            await asyncio.sleep(SCHEDULER_RESYNC)
+
+    async def run(self):
+        self.running = True
+        watcher = asyncio.create_task(self.watch())
         try:
-            await process_queue_iteration()
-        except Exception as e:
-            print(f"[{now_str()}] ❌ Fatal error in background_checker: {e}")
-        await asyncio.sleep(CHECK_INTERVAL)
+            due = True  # catch up on anything that came due while we were down
+            while True:
+                if due:
+                    try:
+                        await process_queue_iteration()
+                    except Exception:
+                        log.exception("Fatal error in background_checker")
+                try:
+                    await asyncio.wait_for(self.wake.wait(), timeout=self.next_delay())
+                except asyncio.TimeoutError:
+                    pass
+                self.wake.clear()
+
+                try:
+                    if not self.watching:
+                        new = await self.resync()
+                        self.poll_interval = POLL_MIN_INTERVAL if new else min(self.poll_interval * 2, CHECK_INTERVAL)
+                    elif time.monotonic() - self.last_resync >= SCHEDULER_RESYNC:
+                        await self.resync()
+                except Exception as e:
+                    log.warning("Scheduler resync failed", extra={"error": str(e)})
+                    await asyncio.sleep(POLL_MIN_INTERVAL)
+                due = self.pop_due() > 0
+        finally:
+            self.running = False
+            watcher.cancel()
+
+scheduler = DueScheduler()
+
+async def background_checker():
+    await asyncio.gather(scheduler.run(), notifier.run())
 
 # -----------------------
 # Handlers and Webhook
@@ -181,7 +1203,7 @@ async def start_handler(message: types.Message):
     try:
         photo = FSInputFile(image_path)
     except Exception as e:
-        print(f"[{now_str()}] ⚠️ Failed to open image: {e}")
+        log.warning("Failed to open image", extra={"path": image_path, "error": str(e)})
         photo = None
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -192,27 +1214,159 @@ async def start_handler(message: types.Message):
     else:
         await message.answer("Hello! (image not found)", reply_markup=keyboard)
 
+@dp.my_chat_member()
+async def bot_membership_handler(event: types.ChatMemberUpdated):
+    chat = event.chat
+    admin_statuses = ("administrator", "creator")
+    push_enabled = member_status(event.new_chat_member) in admin_statuses
+    was_enabled = member_status(event.old_chat_member) in admin_statuses
+    key = channel_cache_key(chat.username) if chat.username else str(chat.id)
+    now = datetime.utcnow()
+    update = {"$set": {"pushEnabled": push_enabled, "pushUpdatedAt": now}}
+    if push_enabled and not was_enabled:
+        # Events missed while the bot was not an admin leave older entries stale.
+        update["$set"]["pushSince"] = now
+    elif not push_enabled:
+        update["$unset"] = {"pushSince": ""}
+    # Push state belongs to the chat, not the username: docs left behind by a
+    # rename share the chatId and are read by it in CheckBatch.prefetch.
+    await channels.update_many({"chatId": int(chat.id), "_id": {"$ne": key}}, update)
+    update["$set"].update(chatId=int(chat.id), username=chat.username)
+    await channels.update_one({"_id": key}, update, upsert=True)
+    log.info("Bot status in chat changed", extra={"chat_id": chat.id, "username": chat.username, "push_enabled": push_enabled})
+
+@dp.chat_member()
+async def chat_member_handler(event: types.ChatMemberUpdated, event_update: types.Update = None):
+    chat = event.chat
+    user_id = int(event.new_chat_member.user.id)
+    status = member_status(event.new_chat_member)
+    # Dispatcher workers run concurrently, so updates may land out of order.
+    event_date = event.date
+    if event_date.tzinfo is not None:
+        event_date = event_date.astimezone(timezone.utc).replace(tzinfo=None)
+    try:
+        update_id = event_update.update_id if event_update is not None else 0
+        await memberships.bulk_write([pushed_membership(int(chat.id), user_id, status, event_date, update_id)])
+    except BulkWriteError as e:
+        if not only_stale_memberships(e):
+            raise
+        task_log.info("Ignoring out-of-order chat_member update", extra={"user_id": user_id, "chat_id": chat.id, "status": status})
+        return
+    if status not in MEMBER_STATUSES:
+        return
+
+    # Bring matching tasks forward; the scheduler picks them up straight away
+    # and the checker answers them from the index without get_chat_member.
+    now = datetime.utcnow()
+    res = await pending.update_many(
+        {"telegramId": str(user_id), "status": "waiting", "channel": {"$in": channel_task_values(chat)}, "checkAfter": {"$gt": now}},
+        {"$set": {"checkAfter": now}}
+    )
+    if res.modified_count:
+        # Without an in-process checker (RUN_CHECKER=0) nobody pops this heap;
+        # the worker's change stream or poll picks the tasks up instead.
+        if scheduler.running:
+            scheduler.schedule(now, f"push:{chat.id}:{user_id}")
+        task_log.info("User joined, pending tasks due now", extra={"user_id": user_id, "chat_id": chat.id, "tasks": res.modified_count})
+
+# In queue mode the webhook only parses, deduplicates and enqueues the update;
+# WEBHOOK_WORKERS dispatcher tasks feed it to aiogram. When the queue stays
+# full for WEBHOOK_ENQUEUE_TIMEOUT we answer 503 so Telegram redelivers later.
+update_queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+seen_updates = TTLCache(UPDATE_DEDUP_SIZE)
+UPDATE_DEDUP_TTL = 3600  # seconds; Telegram gives up redelivering well before this
+dispatch_workers = []
+
+async def dispatch_worker():
+    while True:
+        update = await update_queue.get()
+        started = time.perf_counter()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception:
+            log.exception("Error handling update", extra={"update_id": update.update_id})
+        finally:
+            UPDATE_SECONDS.observe(time.perf_counter() - started)
+            update_queue.task_done()
+
 @app.post("/")
 async def telegram_webhook(request: Request):
-    data = await request.json()
-    update = types.Update(**data)
-    await dp.feed_update(bot, update)
+    started = time.perf_counter()
+    try:
+        return await ingest_update(request)
+    finally:
+        WEBHOOK_SECONDS.observe(time.perf_counter() - started, mode=WEBHOOK_MODE)
+
+async def ingest_update(request: Request):
+    body = await request.body()
+    try:
+        # pydantic-core decodes and validates in one pass, no intermediate dict
+        update = types.Update.model_validate_json(body, context={"bot": bot})
+    except ValidationError as e:
+        log.warning("Ignoring malformed update", extra={"errors": e.error_count()})
+        return PlainTextResponse("ok")
+
+    if seen_updates.get(update.update_id, None) is not None:
+        return PlainTextResponse("ok")
+
+    if WEBHOOK_MODE == "sync":
+        # Marked only once handled, so a redelivery after a handler error is retried.
+        await dp.feed_update(bot, update)
+        seen_updates.set(update.update_id, True, UPDATE_DEDUP_TTL)
+        return PlainTextResponse("ok")
+
+    try:
+        update_queue.put_nowait(update)
+    except asyncio.QueueFull:
+        try:
+            await asyncio.wait_for(update_queue.put(update), timeout=WEBHOOK_ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            log.warning("Update queue full, rejecting update", extra={"queue_size": update_queue.qsize(), "update_id": update.update_id})
+            return PlainTextResponse("busy", status_code=503)
+    seen_updates.set(update.update_id, True, UPDATE_DEDUP_TTL)
     return PlainTextResponse("ok")
 
 @app.get("/")
 def root():
     return PlainTextResponse("Bot is running!")
 
+@app.get("/metrics")
+async def metrics():
+    try:
+        PENDING_TASKS.set(await pending.count_documents({"status": "waiting"}))
+        OUTBOX_PENDING.set(await outbox.count_documents({"status": "pending"}))
+    except Exception as e:
+        log.warning("Failed to count queue depth for metrics", extra={"error": str(e)})
+    UPDATE_QUEUE_SIZE.set(update_queue.qsize())
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 # -----------------------
 # Startup / Shutdown
 # -----------------------
 @app.on_event("startup")
 async def on_startup():
+    if WEBHOOK_MODE != "sync":
+        dispatch_workers.extend(asyncio.create_task(dispatch_worker()) for _ in range(WEBHOOK_WORKERS))
+        log.info("Webhook ingest queue started", extra={"size": WEBHOOK_QUEUE_SIZE, "workers": WEBHOOK_WORKERS})
     if WEBHOOK_URL:
         await safe_set_webhook(WEBHOOK_URL)
+    if not RUN_CHECKER:
+        log.info("RUN_CHECKER disabled, run checker.py as a separate worker")
+        return
+    try:
+        await ensure_indexes()
+    except Exception as e:
+        log.warning("Failed to ensure indexes", extra={"error": str(e)})
     asyncio.create_task(background_checker())
-    print(f"[{now_str()}] 🚀 Background checker started (interval={CHECK_INTERVAL}s)")
+    log.info("Background checker started", extra={"worker": WORKER_ID, "poll_min": POLL_MIN_INTERVAL, "poll_max": CHECK_INTERVAL})
 
 @app.on_event("shutdown")
 async def on_shutdown():
-    print(f"[{now_str()}] ⚠️ FastAPI shutdown — background tasks may be cut off")
+    if dispatch_workers:
+        try:
+            await asyncio.wait_for(update_queue.join(), timeout=5)
+        except asyncio.TimeoutError:
+            log.warning("Queued updates dropped on shutdown", extra={"total": update_queue.qsize()})
+        for worker in dispatch_workers:
+            worker.cancel()
+    log.warning("FastAPI shutdown, background tasks may be cut off")
@@ -0,0 +1,17 @@
+# checker.py — standalone background checker, for running as a separate worker
+import asyncio
+from bot import bot, background_checker, ensure_indexes, log, WORKER_ID
+
+async def main():
+    try:
+        await ensure_indexes()
+    except Exception as e:
+        log.warning("Failed to ensure indexes", extra={"error": str(e)})
+    log.info("Standalone checker started", extra={"worker": WORKER_ID})
+    try:
+        await background_checker()
+    finally:
+        await bot.session.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())